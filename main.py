@@ -2,117 +2,486 @@
 from dotenv import load_dotenv
 load_dotenv()
 import os
+import sys
 import json
 import logging
 import re
-from fastapi import FastAPI, Request
-from pydantic import BaseModel
-from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
+import asyncio
+import time
+from datetime import datetime, timezone
+from dataclasses import dataclass, asdict
+from concurrent.futures import ThreadPoolExecutor
+from fastapi import FastAPI, Response
+import msgspec
+from telegram import Update, Message, InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.ext import (
     Application,
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
+    TypeHandler,
+    ApplicationHandlerStop,
     ContextTypes,
     filters,
 )
+from telegram.request import HTTPXRequest
 import gspread
-from oauth2client.service_account import ServiceAccountCredentials
-from datetime import datetime
+import redis.asyncio as aioredis
+from cachetools import TTLCache
+from google.oauth2.service_account import Credentials
+from google.auth.transport.requests import AuthorizedSession, Request as GoogleAuthRequest
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_random_exponential, before_sleep_log
 import uvicorn
+try:
+    import fcntl  # POSIX only; guards the submissions log against a second writer
+except ImportError:
+    fcntl = None
 
 # --------------------- LOGGING ---------------------
+# Set LOG_LEVEL=WARNING in production; all log calls use lazy %-formatting so
+# suppressed records cost next to nothing.
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    level=logging.INFO
+    level=os.environ.get("LOG_LEVEL", "INFO").upper()
 )
 logger = logging.getLogger("trilokana_bot")
+# httpx logs every Bot API request at INFO; keep library chatter off the per-update path
+logging.getLogger("httpx").setLevel(logging.WARNING)
+logging.getLogger("telegram").setLevel(logging.WARNING)
 
 # --------------------- CONFIG / ENV ---------------------
 BOT_TOKEN = os.environ.get("BOT_TOKEN")
 WEBHOOK_URL = os.environ.get("WEBHOOK_URL")
-SPREADSHEET_NAME = os.environ.get("SPREADSHEET_NAME", "Trilokana_Marketing_Bot_Data")
-
-logger.info(f"BOT_TOKEN set? {BOT_TOKEN is not None}")
-logger.info(f"WEBHOOK_URL set? {WEBHOOK_URL is not None}")
-logger.info(f"SPREADSHEET_NAME: {SPREADSHEET_NAME}")
+# Spreadsheet ID from the Google Sheet URL; opening by key skips the Drive title search
+SPREADSHEET_ID = os.environ.get(
+    "SPREADSHEET_ID",
+    "1iWppZyyrRdV_j_JxUJqC9kFNnYDpBzZPF-56BR1-wYQ"  # fallback if not in env
+)
+REDIS_URL = os.environ.get("REDIS_URL")
+# Discard updates queued while the bot was down (e.g. during a redeploy)
+DROP_PENDING_UPDATES = os.environ.get("DROP_PENDING_UPDATES", "0") == "1"
+# How many updates PTB processes at once, and how many may be queued or in
+# progress before the webhook answers 503 (Telegram redelivers them later)
+MAX_CONCURRENT_UPDATES = int(os.environ.get("MAX_CONCURRENT_UPDATES", 64))
+UPDATE_QUEUE_SIZE = int(os.environ.get("UPDATE_QUEUE_SIZE", 1024))
+# Keep-alive connections to api.telegram.org; one per concurrently running handler
+TELEGRAM_POOL_SIZE = int(os.environ.get("TELEGRAM_POOL_SIZE", MAX_CONCURRENT_UPDATES))
+
+logger.info("BOT_TOKEN set? %s", BOT_TOKEN is not None)
+logger.info("WEBHOOK_URL set? %s", WEBHOOK_URL is not None)
+logger.info("SPREADSHEET_ID: %s", SPREADSHEET_ID)
+logger.info("REDIS_URL set? %s", REDIS_URL is not None)
 
 # --------------------- GOOGLE SHEETS ---------------------
-creds_json = os.environ.get("GOOGLE_CREDENTIALS_JSON")
-if not creds_json:
-    raise ValueError("GOOGLE_CREDENTIALS_JSON not set in env.")
-creds_dict = json.loads(creds_json)
-scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
-creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
-client = gspread.authorize(creds)
-sheet = client.open(SPREADSHEET_NAME).sheet1
+def open_sheet() -> tuple[AuthorizedSession, gspread.Worksheet]:
+    """Authorize once and open the target worksheet; called a single time at import."""
+    creds_json = os.environ.get("GOOGLE_CREDENTIALS_JSON")
+    if not creds_json:
+        raise ValueError("GOOGLE_CREDENTIALS_JSON not set in env.")
+    creds_dict = json.loads(creds_json)
+    scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
+    creds = Credentials.from_service_account_info(creds_dict, scopes=scope)
+    # One keep-alive session for all Sheets calls, so appends reuse the TCP+TLS connection
+    sheets_session = AuthorizedSession(creds)
+    # Connection failures happen before anything is sent, so retrying them at this
+    # layer is safe; 429/5xx on the (non-idempotent) append are handled by tenacity.
+    sheets_session.mount("https://", HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=16,
+        max_retries=Retry(total=3, connect=3, read=0, status=0, other=0, backoff_factor=0.5),
+    ))
+    client = gspread.authorize(creds, session=sheets_session)
+    # gspread passes timeout=None by default, so a stalled connection would hang a
+    # SHEETS_POOL thread (and the flush lock) forever; (connect, read) seconds
+    client.set_timeout((5, 30))
+    return sheets_session, client.open_by_key(SPREADSHEET_ID).sheet1
+
+sheets_session, sheet = open_sheet()
 
 # --------------------- FASTAPI ---------------------
-app = FastAPI()
-
-# --------------------- TELEGRAM APPLICATION ---------------------
-if not BOT_TOKEN:
-    raise ValueError("BOT_TOKEN env var missing.")
-application = Application.builder().token(BOT_TOKEN).build()
+# Serves "/" and the startup/shutdown events; POST /webhook is handled by the
+# raw ASGI `app` below without going through FastAPI routing.
+api = FastAPI()
 
 # --------------------- USER STATE ---------------------
-# Simple in-memory state: { user_id: { step: int, Option, Name, Email, Phone, Query } }
-user_data = {}
-KNOWN_OPTIONS = ["Digital Marketing Strategy", "Paid Marketing", "SEO", "Creatives"]
+# State per user is a Session (see HELPERS).
+# Kept in Redis (one hash per user, expiring after SESSION_TTL) when REDIS_URL is set,
+# so it is shared across workers and survives restarts; otherwise in-memory, with the
+# same TTL and a size cap so abandoned flows can't grow memory without bound.
+SESSION_TTL = int(os.environ.get("SESSION_TTL", 1800))  # seconds
+MAX_SESSIONS = int(os.environ.get("MAX_SESSIONS", 10_000))  # least recently used evicted beyond this
+redis_client = aioredis.Redis.from_url(REDIS_URL, decode_responses=True) if REDIS_URL else None
+user_data = TTLCache(maxsize=MAX_SESSIONS, ttl=SESSION_TTL)
+SERVICE_OPTIONS = ("Digital Marketing Strategy", "Paid Marketing", "SEO", "Creatives")  # display order
+KNOWN_OPTIONS = frozenset(SERVICE_OPTIONS)
+KNOWN_OPTIONS_PROMPT = "Please select a service using /start (buttons) or type one of: " + ", ".join(SERVICE_OPTIONS)
+EMAIL_RE = re.compile(r'^[\w\.-]+@[\w\.-]+\.\w+$', re.ASCII)
+PHONE_STRIP = str.maketrans("", "", " -\t\r\n")  # separators dropped in one pass
+PHONE_DIGITS = str.maketrans("", "", "0123456789")
+
+# --------------------- STATIC REPLIES ---------------------
+# The /start keyboard never changes, so build it once at import: two
+# SERVICE_OPTIONS buttons per row, so the buttons always match KNOWN_OPTIONS.
+WELCOME_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton(option, callback_data=f"option_{option}") for option in SERVICE_OPTIONS[i:i + 2]]
+    for i in range(0, len(SERVICE_OPTIONS), 2)
+])
+WELCOME_TEXT = (
+    "Welcome to Trilokana Marketing!\n"
+    "Visit our website: https://trilokana.com\n\n"
+    "What are you looking for?"
+)
+# Sent as one message (link inline + URL button) instead of two Bot API calls
+WHATSAPP_URL = "https://wa.me/7760225959"
+THANK_YOU_TEXT = (
+    "✅ Thank you! Your details have been recorded. We will contact you soon.\n"
+    f"Contact us via WhatsApp: {WHATSAPP_URL}"
+)
+THANK_YOU_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton("WhatsApp", url=WHATSAPP_URL)]])
 
 # --------------------- VALIDATION ---------------------
 def is_valid_email(email: str) -> bool:
-    pattern = r'^[\w\.-]+@[\w\.-]+\.\w+$'
-    return re.match(pattern, email) is not None
+    return EMAIL_RE.match(email) is not None
 
 def is_valid_phone(phone: str) -> bool:
-    # allow international with + and digits, or plain digits (min 7)
-    normalized = phone.strip().replace(" ", "").replace("-", "")
+    # allow international with + and digits, or plain digits (7-15, the E.164 maximum)
+    if len(phone) < 7:
+        return False  # too short to hold 7 digits; skip the translate passes
+    normalized = phone.translate(PHONE_STRIP)
     if normalized.startswith("+"):
         normalized = normalized[1:]
-    return normalized.isdigit() and len(normalized) >= 7
+    # deleting ASCII digits must leave nothing; isdigit() would also accept e.g. "²" or "٣"
+    return 7 <= len(normalized) <= 15 and not normalized.translate(PHONE_DIGITS)
 
 # --------------------- HELPERS ---------------------
-def reset_user(user_id: int):
-    if user_id in user_data:
+def session_key(user_id: int) -> str:
+    return f"u:{user_id}"
+
+@dataclass(slots=True)
+class Session:
+    """One user's progress through the form; slotted to keep many live sessions small."""
+    step: int = 2
+    option: str = ""
+    name: str = ""
+    email: str = ""
+    phone: str = ""
+    query: str = ""
+
+def new_state(option: str) -> Session:
+    return Session(option=option)
+
+async def get_state(user_id: int):
+    if redis_client is None:
+        return user_data.get(user_id)
+    key = session_key(user_id)
+    fields = await redis_client.hgetall(key)
+    if not fields:
+        return None
+    try:
+        # hash fields come back as str
+        return Session(step=int(fields.pop("step")), **fields)
+    except (KeyError, TypeError, ValueError):
+        logger.warning("Discarding unreadable session for %s: %s", user_id, fields)
+        await redis_client.delete(key)
+        return None
+
+async def save_state(user_id: int, state: Session):
+    if redis_client is None:
+        user_data[user_id] = state
+        return
+    key = session_key(user_id)
+    # DEL + HSET + EXPIRE in one MULTI/EXEC round-trip; the DEL makes the write
+    # replace the hash instead of merging into fields left by an older layout
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.delete(key)
+        pipe.hset(key, mapping=asdict(state))
+        pipe.expire(key, SESSION_TTL)
+        await pipe.execute()
+
+async def reset_user(user_id: int):
+    if redis_client is None:
+        if user_id in user_data:
+            logger.info("Resetting user_data for %s", user_id)
+            del user_data[user_id]
+        return
+    if await redis_client.delete(session_key(user_id)):
         logger.info("Resetting user_data for %s", user_id)
-        del user_data[user_id]
 
-def save_to_sheet_sync(data: dict):
-    """Synchronous save (gspread is sync)."""
+# --------------------- SHEETS WRITE BUFFER ---------------------
+# Completed submissions are queued and written with one append_rows call per
+# batch instead of one append_row round-trip per user. The flusher sleeps until
+# a row arrives, then collects up to FLUSH_BATCH rows for at most FLUSH_INTERVAL s.
+FLUSH_BATCH = int(os.environ.get("FLUSH_BATCH", 50))
+FLUSH_INTERVAL = float(os.environ.get("FLUSH_INTERVAL", 2))
+TS_FMT = "%Y-%m-%d %H:%M:%S"  # sheet timestamp column
+# Queue items are (row, wal_bytes): the row and the size of its submissions-log line (0 without a log)
+pending_rows: asyncio.Queue = asyncio.Queue()
+unsent_rows: list[tuple[list[str], int]] = []  # batch being written (or awaiting retry), in submission order
+flush_lock = asyncio.Lock()
+flush_task = None
+refresh_task = None
+CREDS_REFRESH_MARGIN = 300  # seconds before token expiry
+# gspread is blocking; all Sheets I/O runs here so the event loop stays free
+SHEETS_POOL = ThreadPoolExecutor(max_workers=int(os.environ.get("SHEETS_WORKERS", 8)), thread_name_prefix="sheets")
+# Circuit breaker: after SHEETS_BREAKER_THRESHOLD consecutive failed flushes the
+# flusher leaves Sheets alone for SHEETS_BREAKER_COOLDOWN s - several times one
+# retry cycle of _append_rows_sync, so an outage really sheds load. Rows keep buffering
+# (and going to the submissions log) meanwhile and are sent in one batch once a
+# trial flush succeeds; a failed trial reopens the breaker.
+SHEETS_BREAKER_THRESHOLD = int(os.environ.get("SHEETS_BREAKER_THRESHOLD", 5))
+SHEETS_BREAKER_COOLDOWN = float(os.environ.get("SHEETS_BREAKER_COOLDOWN", 300))
+sheets_failures = 0
+sheets_breaker_open_until = 0.0  # time.monotonic() deadline
+
+# Optional write-ahead log. With SUBMISSIONS_LOG set, every row is appended to that
+# NDJSON file before it is queued, and the byte offset up to which rows have reached
+# the sheet is kept in "<SUBMISSIONS_LOG>.offset". Rows past the offset are replayed
+# on startup, so a crash or a failed final flush can't lose submissions.
+# The byte offset is per process, so the log only works with a single worker: the
+# file is locked exclusively, so a second process (however it was started) fails
+# at startup instead of interleaving rows with the first.
+SUBMISSIONS_LOG = os.environ.get("SUBMISSIONS_LOG")
+wal_file = None
+wal_offset = 0
+
+def open_submissions_log():
+    """Open the submissions log and re-queue every row the sheet hasn't confirmed yet."""
+    global wal_file, wal_offset
+    if int(os.environ.get("WEB_CONCURRENCY", 1)) > 1:
+        raise RuntimeError("SUBMISSIONS_LOG requires a single worker process; unset it or run one worker.")
+    log_file = open(SUBMISSIONS_LOG, "a+b")
+    if fcntl is not None:
+        try:
+            fcntl.flock(log_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            log_file.close()
+            raise RuntimeError(f"{SUBMISSIONS_LOG} is in use by another process; run a single worker.") from None
+    wal_file = log_file
     try:
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        row = [timestamp, data["Option"], data["Name"], data["Email"], data["Phone"], data["Query"]]
-        sheet.append_row(row)
-        logger.info("Saved row to Google Sheet: %s", row)
+        with open(SUBMISSIONS_LOG + ".offset") as f:
+            wal_offset = int(f.read())
+    except (FileNotFoundError, ValueError):
+        wal_offset = 0
+    if wal_offset > wal_file.seek(0, os.SEEK_END):
+        # crash between truncating the log and rewriting the offset: every row was sent
+        logger.warning("Offset %d is past the end of %s; replaying from the start", wal_offset, SUBMISSIONS_LOG)
+        wal_offset = 0
+    wal_file.seek(wal_offset)
+    position = wal_offset
+    skipped = 0  # bytes of unreadable lines, carried by the next good row so the offset moves past them
+    for line in wal_file:
+        if not line.endswith(b"\n"):
+            break  # torn final write from a crash
+        try:
+            row = msgspec.json.decode(line, type=list[str])
+        except msgspec.DecodeError as e:
+            logger.error("Skipping unreadable line at byte %d of %s: %s", position + skipped, SUBMISSIONS_LOG, e)
+            skipped += len(line)
+            continue
+        pending_rows.put_nowait((row, skipped + len(line)))
+        position += skipped + len(line)
+        skipped = 0
+    # drop the torn tail (and unreadable lines with no good row after them) so new rows start on a clean line
+    wal_file.truncate(position)
+    if not pending_rows.empty():
+        logger.info("Replaying %d unsent row(s) from %s", pending_rows.qsize(), SUBMISSIONS_LOG)
+
+def advance_submissions_log(nbytes: int):
+    """Record that the next nbytes of the log reached the sheet; truncate once all have."""
+    global wal_offset
+    wal_offset += nbytes
+    if wal_offset == wal_file.seek(0, os.SEEK_END):
+        wal_file.truncate(0)
+        wal_offset = 0
+    tmp_path = SUBMISSIONS_LOG + ".offset.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(str(wal_offset))
+    os.replace(tmp_path, SUBMISSIONS_LOG + ".offset")
+
+def submission_row(state: Session) -> list[str]:
+    # stamped at submission time (not flush time) in UTC, independent of container TZ
+    timestamp = time.strftime(TS_FMT, time.gmtime())
+    return [timestamp, state.option, state.name, state.email, state.phone, state.query]
+
+def queue_row(row: list[str]):
+    """Buffer a completed submission; the flush loop writes it to the sheet."""
+    wal_bytes = 0
+    if wal_file is not None:
+        line = msgspec.json.encode(row) + b"\n"
+        wal_file.write(line)
+        wal_file.flush()
+        wal_bytes = len(line)
+    pending_rows.put_nowait((row, wal_bytes))
+    logger.info("Queued row for Google Sheet (%d pending): %s", pending_rows.qsize(), row)
+
+def is_transient_sheets_error(exc: BaseException) -> bool:
+    """429 (quota) and 5xx from Sheets, or a dropped connection, are worth retrying."""
+    if isinstance(exc, gspread.exceptions.APIError):
+        status = exc.response.status_code
+        return status == 429 or status >= 500
+    return isinstance(exc, requests.exceptions.ConnectionError)
+
+# Exponential backoff with jitter so retries back off instead of piling onto a throttle;
+# the whole flushed batch is retried as one append_rows call.
+@retry(
+    retry=retry_if_exception(is_transient_sheets_error),
+    wait=wait_random_exponential(multiplier=0.5, max=30),
+    stop=stop_after_attempt(6),
+    before_sleep=before_sleep_log(logger, logging.WARNING),
+    reraise=True,
+)
+def _append_rows_sync(rows: list[list[str]]):
+    sheet.append_rows(rows, value_input_option="RAW")
+
+# Serverless entry: a single attempt, so a failure is reported to the user within the
+# request instead of backing off past the function's time limit.
+_append_rows_once = _append_rows_sync.retry_with(stop=stop_after_attempt(1))
+
+async def flush_rows() -> bool:
+    """Write unsent rows plus everything queued in a single API call on the Sheets thread pool."""
+    async with flush_lock:
+        while not pending_rows.empty():
+            unsent_rows.append(pending_rows.get_nowait())
+        if not unsent_rows:
+            return True
+        rows = [row for row, _ in unsent_rows]
+        try:
+            await asyncio.get_running_loop().run_in_executor(SHEETS_POOL, _append_rows_sync, rows)
+        except Exception as e:
+            # rows stay in unsent_rows for the next attempt
+            logger.exception("Failed flushing %d row(s) to Google Sheet: %s", len(rows), e)
+            record_sheets_failure()
+            return False
+        logger.info("Flushed %d row(s) to Google Sheet", len(rows))
+        record_sheets_success()
+        if wal_file is not None:
+            advance_submissions_log(sum(wal_bytes for _, wal_bytes in unsent_rows))
+        unsent_rows.clear()
         return True
+
+def record_sheets_failure():
+    global sheets_failures, sheets_breaker_open_until
+    sheets_failures += 1
+    if sheets_failures >= SHEETS_BREAKER_THRESHOLD:
+        sheets_breaker_open_until = time.monotonic() + SHEETS_BREAKER_COOLDOWN
+        logger.warning("Sheets breaker open after %d failed flush(es); pausing writes for %ss",
+                       sheets_failures, SHEETS_BREAKER_COOLDOWN)
+
+def record_sheets_success():
+    global sheets_failures
+    if sheets_failures >= SHEETS_BREAKER_THRESHOLD:
+        logger.info("Sheets breaker closed")
+    sheets_failures = 0
+
+async def sheet_flusher():
+    loop = asyncio.get_running_loop()
+    while True:
+        if not unsent_rows:
+            unsent_rows.append(await pending_rows.get())
+        deadline = loop.time() + FLUSH_INTERVAL
+        while len(unsent_rows) < FLUSH_BATCH:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                unsent_rows.append(await asyncio.wait_for(pending_rows.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        if not await flush_rows():
+            # back off before retrying the same batch; wait out an open breaker
+            await asyncio.sleep(max(FLUSH_INTERVAL, sheets_breaker_open_until - time.monotonic()))
+
+# Token refreshes go through their own session: sending them through sheets_session
+# would attach the old bearer token and, with pool_connections=1, evict the pooled
+# sheets.googleapis.com connection on every refresh.
+token_request = GoogleAuthRequest()
+
+def _refresh_creds_sync():
+    sheets_session.credentials.refresh(token_request)
+
+async def creds_refresher():
+    """Refresh the Sheets token ahead of expiry so no flush pays the token round-trip."""
+    loop = asyncio.get_running_loop()
+    while True:
+        expiry = sheets_session.credentials.expiry  # naive UTC, None before first refresh
+        if expiry is not None:
+            now = datetime.now(timezone.utc).replace(tzinfo=None)
+            await asyncio.sleep(max((expiry - now).total_seconds() - CREDS_REFRESH_MARGIN, 0))
+        try:
+            await loop.run_in_executor(SHEETS_POOL, _refresh_creds_sync)
+            logger.info("Refreshed Google credentials (expires %s)", sheets_session.credentials.expiry)
+            if sheets_session.credentials.expiry is None:
+                return  # token never expires; nothing left to refresh
+        except Exception as e:
+            logger.warning("Google credentials refresh failed: %s", e)
+            await asyncio.sleep(60)
+
+# --------------------- RATE LIMIT ---------------------
+# Per-user token bucket: up to RATE_LIMIT_BURST updates at once, refilled at
+# RATE_LIMIT_PER_MINUTE. Keeps one user from burning the Sheets/Telegram quotas.
+# With Redis, a per-minute counter shared by all workers is used instead.
+# Only the first rejected update in a row gets a "slow down" reply; the rest are
+# dropped silently, so a flooding user doesn't cost a Bot API call per message.
+RATE_LIMIT_BURST = int(os.environ.get("RATE_LIMIT_BURST", 10))
+RATE_LIMIT_PER_MINUTE = float(os.environ.get("RATE_LIMIT_PER_MINUTE", 20))
+# { user_id: (tokens, last_ts, notified) }; an idle bucket is full again after the TTL, so it can be dropped
+rate_buckets = TTLCache(maxsize=MAX_SESSIONS, ttl=60 * RATE_LIMIT_BURST / RATE_LIMIT_PER_MINUTE)
+
+def consume_token(user_id: int) -> tuple[bool, bool]:
+    """Returns (allowed, notify); notify is True only for the first rejection since the last allowed update."""
+    now = time.monotonic()
+    tokens, last_ts, notified = rate_buckets.get(user_id, (RATE_LIMIT_BURST, now, False))
+    tokens = min(RATE_LIMIT_BURST, tokens + (now - last_ts) * RATE_LIMIT_PER_MINUTE / 60)
+    if tokens >= 1:
+        rate_buckets[user_id] = (tokens - 1, now, False)
+        return True, False
+    rate_buckets[user_id] = (tokens, now, True)
+    return False, not notified
+
+async def consume_token_shared(user_id: int) -> tuple[bool, bool]:
+    """Fixed one-minute window counted in Redis (INCR + EXPIRE), so the limit holds across workers."""
+    key = f"rl:{user_id}:{int(time.time() // 60)}"
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.incr(key)
+        pipe.expire(key, 60)
+        count, _ = await pipe.execute()
+    if count <= RATE_LIMIT_PER_MINUTE:
+        return True, False
+    return False, count == int(RATE_LIMIT_PER_MINUTE) + 1  # first rejection in this window
+
+async def rate_limit(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Runs before all other handlers (group -1); stops the update if the user is over the limit."""
+    user = update.effective_user
+    if user is None:
+        return
+    if redis_client is not None:
+        allowed, notify = await consume_token_shared(user.id)
+    else:
+        allowed, notify = consume_token(user.id)
+    if allowed:
+        return
+    try:
+        if notify:
+            logger.warning("Rate limited user %s", user.id)
+            if update.callback_query:
+                await update.callback_query.answer("Please slow down a little.")
+            elif update.effective_message:
+                await update.effective_message.reply_text("You're sending messages too fast. Please wait a moment and try again.")
     except Exception as e:
-        logger.exception("Failed saving to Google Sheet: %s", e)
-        return False
+        # swallowed: an error escaping this handler would let PTB run the other groups
+        logger.warning("Could not tell user %s about the rate limit: %s", user.id, e)
+    raise ApplicationHandlerStop
 
 # --------------------- HANDLERS ---------------------
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    keyboard = [
-        [
-            InlineKeyboardButton("Digital Marketing Strategy", callback_data="option_Digital Marketing Strategy"),
-            InlineKeyboardButton("Paid Marketing", callback_data="option_Paid Marketing"),
-        ],
-        [
-            InlineKeyboardButton("SEO", callback_data="option_SEO"),
-            InlineKeyboardButton("Creatives", callback_data="option_Creatives"),
-        ],
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    welcome_text = (
-        "Welcome to Trilokana Marketing!\n"
-        "Visit our website: https://trilokana.com\n\n"
-        "What are you looking for?"
-    )
     logger.info("User %s invoked /start", update.effective_user.id if update.effective_user else "unknown")
     if update.message:
-        await update.message.reply_text(welcome_text, reply_markup=reply_markup)
+        await update.message.reply_text(WELCOME_TEXT, reply_markup=WELCOME_MARKUP)
     elif update.effective_chat:
-        await context.bot.send_message(chat_id=update.effective_chat.id, text=welcome_text, reply_markup=reply_markup)
+        await context.bot.send_message(chat_id=update.effective_chat.id, text=WELCOME_TEXT, reply_markup=WELCOME_MARKUP)
 
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -134,15 +503,9 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Option selection
     if data.startswith("option_"):
         selected_option = data.replace("option_", "")
-        user_data[user_id] = {
-            "step": 2,
-            "Option": selected_option,
-            "Name": "",
-            "Email": "",
-            "Phone": "",
-            "Query": ""
-        }
-        logger.info("User %s selected option: %s ; state=%s", user_id, selected_option, user_data[user_id])
+        state = new_state(selected_option)
+        await save_state(user_id, state)
+        logger.info("User %s selected option: %s ; state=%s", user_id, selected_option, state)
         # remove inline keyboard to avoid duplicate clicks
         try:
             await query.message.edit_reply_markup(reply_markup=None)
@@ -164,117 +527,297 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.info("Message from %s: %s", user_id, text[:120])
 
     # If user hasn't started by clicking option, allow typing a known option as fallback
-    if user_id not in user_data:
+    state = await get_state(user_id)
+    if state is None:
         if text in KNOWN_OPTIONS:
-            user_data[user_id] = {
-                "step": 2,
-                "Option": text,
-                "Name": "",
-                "Email": "",
-                "Phone": "",
-                "Query": ""
-            }
+            await save_state(user_id, new_state(text))
             logger.info("User %s typed known option: %s", user_id, text)
             await message.reply_text("Enter your Name:")
             return
         else:
-            await message.reply_text("Please select a service using /start (buttons) or type one of: " + ", ".join(KNOWN_OPTIONS))
+            await message.reply_text(KNOWN_OPTIONS_PROMPT)
             return
 
     # Continue flow based on step
-    step = user_data[user_id].get("step", 2)
+    step = state.step
     logger.info("User %s current step: %s", user_id, step)
-
-    # 2 -> Name
-    if step == 2:
-        user_data[user_id]["Name"] = text
-        user_data[user_id]["step"] = 3
-        await message.reply_text("Enter your Email:")
+    step_handler = STEP_HANDLERS.get(step)
+    if step_handler:
+        await step_handler(user_id, state, message, text)
         return
 
-    # 3 -> Email
-    if step == 3:
-        if not is_valid_email(text):
-            await message.reply_text("Invalid email format. Please enter a valid email (example@example.com):")
-            return
-        user_data[user_id]["Email"] = text
-        user_data[user_id]["step"] = 4
-        await message.reply_text("Enter your Phone Number (digits, min 10):")
+    # fallback
+    logger.warning("Unhandled step %s for user %s", step, user_id)
+    await message.reply_text("Something went wrong. Please send /start to begin again.")
+    await reset_user(user_id)
+
+# --------------------- FORM STEPS ---------------------
+# One coroutine per step of the form, dispatched from handle_message via STEP_HANDLERS.
+async def step_name(user_id: int, state: Session, message: Message, text: str):
+    state.name = text
+    state.step = 3
+    await save_state(user_id, state)
+    await message.reply_text("Enter your Email:")
+
+async def step_email(user_id: int, state: Session, message: Message, text: str):
+    if not is_valid_email(text):
+        await message.reply_text("Invalid email format. Please enter a valid email (example@example.com):")
         return
-
-    # 4 -> Phone
-    if step == 4:
-        if not is_valid_phone(text):
-            await message.reply_text("Invalid phone! Please enter digits only (min 7). You may include + for country code.")
-            return
-        user_data[user_id]["Phone"] = text
-        user_data[user_id]["step"] = 5
-        await message.reply_text("Enter your Query / Message:")
+    state.email = text
+    state.step = 4
+    await save_state(user_id, state)
+    await message.reply_text("Enter your Phone Number (7-15 digits, + for country code allowed):")
+
+async def step_phone(user_id: int, state: Session, message: Message, text: str):
+    if not is_valid_phone(text):
+        await message.reply_text("Invalid phone! Please enter digits only (7-15 digits). You may include + for country code.")
         return
+    state.phone = text
+    state.step = 5
+    await save_state(user_id, state)
+    await message.reply_text("Enter your Query / Message:")
+
+async def step_query(user_id: int, state: Session, message: Message, text: str):
+    # final step -> SAVE (buffered, flushed in the background)
+    state.query = text
+    logger.info("User %s completed data collection: %s", user_id, state)
+    row = submission_row(state)
+    if flush_task is None:
+        # no background flusher (serverless entry, see SERVERLESS): write before confirming
+        try:
+            await asyncio.get_running_loop().run_in_executor(SHEETS_POOL, _append_rows_once, [row])
+        except Exception as e:
+            logger.exception("Failed writing row to Google Sheet: %s", e)
+            await message.reply_text("Sorry, we couldn't save your details right now. Please send your query again.")
+            return  # state kept, so resending the query retries the write
+    else:
+        queue_row(row)
+    await message.reply_text(THANK_YOU_TEXT, reply_markup=THANK_YOU_MARKUP, disable_web_page_preview=True)
+    # cleanup user state
+    await reset_user(user_id)
 
-    # 5 -> Query (final) -> SAVE immediately (Flow A)
-    if step == 5:
-        user_data[user_id]["Query"] = text
-        logger.info("User %s completed data collection: %s", user_id, user_data[user_id])
-        # Save synchronously to Google Sheets
-        success = save_to_sheet_sync(user_data[user_id])
-        if success:
-            await message.reply_text("✅ Thank you! Your details have been recorded. We will contact you soon.")
-            await message.reply_text("Contact us via WhatsApp: https://wa.me/7760225959")
-        else:
-            await message.reply_text("Sorry, there was an error saving your data. Please try again later.")
-        # cleanup user state
-        reset_user(user_id)
-        return
+STEP_HANDLERS = {2: step_name, 3: step_email, 4: step_phone, 5: step_query}
 
-    # fallback
-    logger.warning("Unhandled step %s for user %s", step, user_id)
-    await message.reply_text("Something went wrong. Please send /start to begin again.")
-    reset_user(user_id)
+# --------------------- TELEGRAM APPLICATION ---------------------
+# PTB's fetcher moves every update off update_queue straight into its own task,
+# so the queue never fills up; the backlog is bounded by counting updates from
+# the webhook until process_update returns instead.
+updates_in_flight = 0
+
+class CountingApplication(Application):
+    async def process_update(self, update: object) -> None:
+        global updates_in_flight
+        try:
+            await super().process_update(update)
+        finally:
+            updates_in_flight -= 1
+
+def build_application() -> Application:
+    """Build the Telegram application and register the handlers; called a single time at import."""
+    if not BOT_TOKEN:
+        raise ValueError("BOT_TOKEN env var missing.")
+    application = (
+        Application.builder()
+        .application_class(CountingApplication)
+        .token(BOT_TOKEN)
+        # Bot API calls share one pooled client so TLS setup is paid once per
+        # connection; fail fast when the pool is exhausted instead of queueing.
+        .request(HTTPXRequest(
+            connection_pool_size=TELEGRAM_POOL_SIZE,
+            connect_timeout=5,
+            read_timeout=15,
+            pool_timeout=1,
+        ))
+        .concurrent_updates(MAX_CONCURRENT_UPDATES)
+        .build()
+    )
+    application.add_handler(TypeHandler(Update, rate_limit), group=-1)
+    application.add_handler(CommandHandler("start", start))
+    application.add_handler(CallbackQueryHandler(button_handler))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    return application
 
-# --------------------- REGISTER HANDLERS ---------------------
-application.add_handler(CommandHandler("start", start))
-application.add_handler(CallbackQueryHandler(button_handler))
-application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+application = build_application()
 
 # --------------------- WEBHOOK ---------------------
-class TelegramUpdate(BaseModel):
-    update_id: int
-    message: dict = None
-    callback_query: dict = None
-
-@app.post("/webhook")
-async def telegram_webhook(update: TelegramUpdate, request: Request):
-    update_dict = update.dict()
-    logger.info("Incoming update id=%s", update_dict.get("update_id"))
-    telegram_update = Update.de_json(update_dict, application.bot)
+# Updates are handed to PTB's update_queue so Telegram gets its 200 right away;
+# the application's own fetcher (started in startup) processes them, up to
+# MAX_CONCURRENT_UPDATES at a time. Once UPDATE_QUEUE_SIZE updates are queued or
+# in progress the webhook answers 503, and Telegram retries the update later
+# instead of the backlog growing without bound.
+def decode_update(body: bytes):
+    """Decode a webhook body into an Update; None if malformed."""
+    # decode straight to the dict Update.de_json wants - no intermediate model
+    try:
+        update_dict = msgspec.json.decode(body, type=dict)
+    except msgspec.DecodeError as e:
+        logger.warning("Rejected malformed update: %s", e)
+        return None
+    if "update_id" not in update_dict:
+        logger.warning("Rejected update without update_id")
+        return None
+    logger.info("Incoming update id=%s", update_dict["update_id"])
+    logger.debug("Incoming update body: %s", update_dict)  # repr only built when DEBUG is on
+    return Update.de_json(update_dict, application.bot)
+
+def dispatch_update(body: bytes) -> int:
+    """Decode a webhook body and enqueue it for processing; returns the HTTP status to answer with."""
+    global updates_in_flight
+    if updates_in_flight >= UPDATE_QUEUE_SIZE:
+        logger.warning("%d updates in flight; asking Telegram to retry later", updates_in_flight)
+        return 503
+    telegram_update = decode_update(body)
+    if telegram_update is None:
+        return 400
+    application.update_queue.put_nowait(telegram_update)
+    updates_in_flight += 1
+    return 200
+
+OK_BODY = b'{"ok":true}'
+ERROR_BODY = b'{"ok":false}'
+
+def json_headers(body: bytes) -> list:
+    return [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())]
+
+OK_HEADERS = json_headers(OK_BODY)
+ERROR_HEADERS = json_headers(ERROR_BODY)
+
+async def read_body(receive) -> bytes:
+    body = b""
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get("body", b"")
+        more_body = message.get("more_body", False)
+    return body
+
+async def send_status(send, status: int):
+    headers, body = (OK_HEADERS, OK_BODY) if status == 200 else (ERROR_HEADERS, ERROR_BODY)
+    await send({"type": "http.response.start", "status": status, "headers": headers})
+    await send({"type": "http.response.body", "body": body})
+
+def is_webhook(scope) -> bool:
+    return scope["type"] == "http" and scope["path"] == "/webhook" and scope["method"] == "POST"
+
+async def app(scope, receive, send):
+    """ASGI entry point: POST /webhook is answered directly, everything else goes to FastAPI.
+
+    Acks before processing and writes rows from a background task, so it must run
+    as a long-lived process (python main.py / uvicorn main:app), not serverless.
+    """
+    if is_webhook(scope):
+        await send_status(send, dispatch_update(await read_body(receive)))
+        return
+    await api(scope, receive, send)
+
+# --------------------- SERVERLESS ---------------------
+# api/bot.py (Vercel) serves serverless_app instead. A serverless function gets no
+# lifespan events and is frozen once the response is sent, so nothing may be left
+# running after it: each update is processed before the 200, and with no flusher
+# started step_query writes its row to the sheet before confirming to the user.
+# The webhook itself has to be registered separately (e.g. one `python main.py` run).
+serverless_ready = False
+SERVERLESS_SHEETS_TIMEOUT = (3, 10)  # (connect, read) seconds
+
+async def serverless_app(scope, receive, send):
+    global serverless_ready, updates_in_flight
+    if scope["type"] == "lifespan":
+        # acknowledge without running api's startup, which would start the background tasks
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+    if not is_webhook(scope):
+        await api(scope, receive, send)
+        return
+    if not serverless_ready:
+        await application.initialize()  # once per cold start
+        # rows are written inside the request here, so don't wait out long stalls
+        sheet.client.set_timeout(SERVERLESS_SHEETS_TIMEOUT)
+        serverless_ready = True
+    telegram_update = decode_update(await read_body(receive))
+    if telegram_update is None:
+        await send_status(send, 400)
+        return
+    updates_in_flight += 1  # CountingApplication.process_update decrements it
     await application.process_update(telegram_update)
-    return {"ok": True}
+    await send_status(send, 200)
 
-@app.get("/")
+# The health check body is constant, so encode it once and skip FastAPI's
+# per-request jsonable_encoder/json.dumps pass.
+ROOT_BODY = msgspec.json.encode({"message": "Trilokana Telegram Bot is running!"})
+
+@api.get("/")
 async def root():
-    return {"message": "Trilokana Telegram Bot is running!"}
+    return Response(ROOT_BODY, media_type="application/json")
 
 # --------------------- STARTUP & SHUTDOWN ---------------------
-@app.on_event("startup")
+@api.on_event("startup")
 async def startup():
+    global flush_task, refresh_task
+    if SUBMISSIONS_LOG:
+        open_submissions_log()
     logger.info("Initializing Telegram application...")
     await application.initialize()
+    await application.start()
+    flush_task = asyncio.create_task(sheet_flusher())
+    refresh_task = asyncio.create_task(creds_refresher())
     if WEBHOOK_URL:
         try:
-            await application.bot.set_webhook(WEBHOOK_URL)
+            # only subscribe to the update types we have handlers for
+            await application.bot.set_webhook(
+                WEBHOOK_URL,
+                allowed_updates=[Update.MESSAGE, Update.CALLBACK_QUERY],
+                drop_pending_updates=DROP_PENDING_UPDATES,
+            )
             logger.info("Webhook set to %s", WEBHOOK_URL)
         except Exception as e:
             logger.exception("Failed to set webhook: %s", e)
     else:
         logger.warning("WEBHOOK_URL not set; bot will not set webhook (use polling locally).")
 
-@app.on_event("shutdown")
+@api.on_event("shutdown")
 async def shutdown():
     logger.info("Shutting down Telegram application...")
+    # processes whatever is still queued, so those rows make it into the buffer
+    if application.running:
+        await application.stop()
+    if refresh_task:
+        refresh_task.cancel()
+    if flush_task:
+        async with flush_lock:  # never cancel the flusher in the middle of a write
+            flush_task.cancel()
+        await asyncio.gather(flush_task, return_exceptions=True)
+    # drain anything still buffered so it isn't lost on shutdown
+    await flush_rows()
+    SHEETS_POOL.shutdown(wait=True)
+    if wal_file is not None:
+        wal_file.close()
+    if redis_client is not None:
+        await redis_client.aclose()
     await application.shutdown()
 
 # --------------------- RUN ---------------------
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 8000))
-    uvicorn.run("main:app", host="0.0.0.0", port=port, reload=False)
+    # 2n+1 workers by default, but only when user state is shared through Redis
+    # and no submissions log is kept (it is single-process)
+    default_workers = (os.cpu_count() or 1) * 2 + 1 if REDIS_URL and not SUBMISSIONS_LOG else 1
+    workers = int(os.environ.get("WEB_CONCURRENCY", default_workers))
+    if workers > 1 and not REDIS_URL:
+        logger.warning("WEB_CONCURRENCY=%s without REDIS_URL: each worker keeps its own user state.", workers)
+    if workers > 1 and SUBMISSIONS_LOG:
+        sys.exit(f"WEB_CONCURRENCY={workers} with SUBMISSIONS_LOG: the log requires a single worker process.")
+    # uvloop (libuv) and httptools replace the stdlib loop and the pure-Python h11 parser
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=port,
+        reload=False,
+        loop="uvloop" if sys.platform != "win32" else "asyncio",
+        http="httptools",
+        workers=workers,
+    )
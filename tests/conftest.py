@@ -0,0 +1,34 @@
+# tests/conftest.py
+# main.py authorizes against Google Sheets at import; swap in a fake worksheet
+# and dummy credentials so the module can be imported offline.
+import json
+import os
+import sys
+import types
+
+import gspread
+import google.oauth2.service_account as service_account
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ["BOT_TOKEN"] = "123:TEST"
+os.environ["GOOGLE_CREDENTIALS_JSON"] = json.dumps({"type": "service_account"})
+os.environ.pop("REDIS_URL", None)
+os.environ.pop("SUBMISSIONS_LOG", None)
+
+
+class FakeSheet:
+    def __init__(self):
+        self.rows = []
+
+    def append_rows(self, rows, **kwargs):
+        self.rows.extend(rows)
+
+
+fake_book = types.SimpleNamespace(sheet1=FakeSheet())
+service_account.Credentials.from_service_account_info = staticmethod(
+    lambda *args, **kwargs: types.SimpleNamespace(expiry=None)
+)
+gspread.authorize = lambda *args, **kwargs: types.SimpleNamespace(
+    open_by_key=lambda key: fake_book, set_timeout=lambda timeout: None
+)
@@ -0,0 +1,99 @@
+# tests/test_submissions_log.py
+import asyncio
+
+import msgspec
+import pytest
+
+import main
+
+
+def line(*row) -> bytes:
+    return msgspec.json.encode(list(row)) + b"\n"
+
+
+@pytest.fixture
+def log_path(tmp_path, monkeypatch):
+    path = tmp_path / "submissions.ndjson"
+    monkeypatch.setattr(main, "SUBMISSIONS_LOG", str(path))
+    monkeypatch.setattr(main, "pending_rows", asyncio.Queue())
+    yield path
+    if main.wal_file is not None:
+        main.wal_file.close()
+        main.wal_file = None
+
+
+def write_offset(path, offset: int):
+    (path.parent / (path.name + ".offset")).write_text(str(offset))
+
+
+def read_offset(path) -> int:
+    return int((path.parent / (path.name + ".offset")).read_text())
+
+
+def replayed() -> list:
+    items = []
+    while not main.pending_rows.empty():
+        items.append(main.pending_rows.get_nowait())
+    return items
+
+
+def test_replays_rows_past_offset(log_path):
+    first, second, third = line("1", "a"), line("2", "b"), line("3", "c")
+    log_path.write_bytes(first + second + third)
+    write_offset(log_path, len(first))
+    main.open_submissions_log()
+    assert replayed() == [(["2", "b"], len(second)), (["3", "c"], len(third))]
+
+
+def test_cuts_torn_tail(log_path):
+    good = line("1", "a")
+    log_path.write_bytes(good + b'["2", "b')
+    main.open_submissions_log()
+    assert replayed() == [(["1", "a"], len(good))]
+    assert log_path.read_bytes() == good
+
+
+def test_truncates_once_everything_is_sent(log_path):
+    first, second = line("1", "a"), line("2", "b")
+    log_path.write_bytes(first + second)
+    main.open_submissions_log()
+    main.advance_submissions_log(sum(nbytes for _, nbytes in replayed()))
+    assert log_path.read_bytes() == b""
+    assert read_offset(log_path) == 0
+
+
+def test_offset_past_end_replays_from_start(log_path):
+    # crash after truncate(0) but before the offset was rewritten
+    row = line("1", "a")
+    log_path.write_bytes(row)
+    write_offset(log_path, 500)
+    main.open_submissions_log()
+    assert replayed() == [(["1", "a"], len(row))]
+
+
+def test_skips_unreadable_lines(log_path):
+    junk, good = b'b"]\n', line("2", "b")
+    log_path.write_bytes(junk + good + b"not json\n")
+    main.open_submissions_log()
+    items = replayed()
+    # the junk before a good row is carried by it; trailing junk is cut off
+    assert items == [(["2", "b"], len(junk) + len(good))]
+    assert log_path.read_bytes() == junk + good
+    main.advance_submissions_log(items[0][1])
+    assert log_path.read_bytes() == b""
+
+
+def test_refuses_multiple_workers(log_path, monkeypatch):
+    monkeypatch.setenv("WEB_CONCURRENCY", "3")
+    with pytest.raises(RuntimeError):
+        main.open_submissions_log()
+    assert not log_path.exists()
+
+
+@pytest.mark.skipif(main.fcntl is None, reason="needs fcntl.flock")
+def test_refuses_log_locked_by_another_writer(log_path):
+    with open(log_path, "a+b") as other:
+        main.fcntl.flock(other.fileno(), main.fcntl.LOCK_EX | main.fcntl.LOCK_NB)
+        with pytest.raises(RuntimeError):
+            main.open_submissions_log()
+    assert main.wal_file is None